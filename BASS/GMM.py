@@ -9,9 +9,14 @@ sys.path.append('./BASS/')
 import numpy as np
 import scipy.stats as stats
 from scipy.stats import norm
+from scipy.special import logsumexp
 from copy import deepcopy
 import bass as md
 
+# Number of samples processed at a time by the log densities, the M step covariances (full and diag)
+# and _compute_states, keeps the numclasses x TILE_SIZE x dim temporaries small enough to stay in cache
+TILE_SIZE = 1024
+
 class GMM_synthetic:
     """
     Definition of the model. This is important. 
@@ -32,115 +37,238 @@ class GMM_model:
     """
     This is our implementation of a GMM used to fit multiple datasets simultaneously (see paper). 
     Not used for the synthetic dataset.
+    covariance_type is 'full' (covars_ is numclasses x dim x dim) or 'diag' (covars_ holds the variances, numclasses x dim)
     """
-    def __init__(self,numclasses):
+    def __init__(self,numclasses,covariance_type='full'):
+        if covariance_type not in ('full','diag'):
+            raise ValueError("covariance_type should be 'full' or 'diag', got %r" %covariance_type)
         self.numclasses = numclasses
+        self.covariance_type = covariance_type
         
-    def E_step(self,datasets):
-        N = datasets.shape[1]
-        numsets = datasets.shape[0]
-        gamma_ = np.zeros((numsets,N,self.numclasses))
-        for k in range(self.numclasses):
-            gamma_[:,:,k] = 1e-20 + self.weights_[:,k][:,np.newaxis]*stats.multivariate_normal.pdf(datasets,mean = self.means_[k],cov = self.covars_[k])
-        gamma_ = gamma_/np.sum(gamma_,axis=2)[:,:,np.newaxis]
+    def E_step(self,datasets,logjoint=None):
+        # logjoint: log joint of the current parameters if already computed (see _compute_logjoint)
+        if logjoint is None:
+            logjoint = self._compute_logjoint(datasets)
+        gamma_ = 1e-20 + np.exp(logjoint - logsumexp(logjoint,axis=2)[:,:,None])
+        gamma_ = gamma_/np.sum(gamma_,axis=2)[:,:,None]
         return gamma_
     
     def M_step(self,datasets,gamma_):
-        for k in range(self.numclasses):
-            Nk = np.sum(gamma_[:,:,k])
-            self.means_[k] = np.sum(np.sum(gamma_[:,:,k][:,:,None]*datasets,axis=1),axis=0)/Nk
-            outerprod = (datasets - self.means_[k])[:,:,:,None]*(datasets - self.means_[k])[:,:,None,:]
-            self.covars_[k] = np.sum(np.sum(gamma_[:,:,k][:,:,None,None]*outerprod,axis=1),axis=0)/Nk
-            self.weights_ = np.sum(gamma_,axis=1)/self.N
+        # sufficient statistics as matrix products of the responsibilities with the data
+        datasets_flat = np.reshape(datasets,(-1,datasets.shape[2]))
+        gamma_flat = np.reshape(gamma_,(-1,self.numclasses))
+        Nk = np.sum(gamma_flat,axis=0)
+        self.means_ = (gamma_flat.T @ datasets_flat)/Nk[:,None]
+        # covariances from the centred data (x - means_[k]), which cannot cancel to negative variances
+        if self.covariance_type == 'diag':
+            self.covars_ = np.zeros((self.numclasses,self.dim),dtype=self.means_.dtype)
+            for start in range(0,len(datasets_flat),TILE_SIZE):
+                diff = datasets_flat[None,start:start + TILE_SIZE,:] - self.means_[:,None,:]
+                diff *= diff
+                self.covars_ += np.matmul(gamma_flat[start:start + TILE_SIZE].T[:,None,:],diff)[:,0]
+            self.covars_ /= Nk[:,None]
+        else:
+            self.covars_ = np.zeros((self.numclasses,self.dim,self.dim),dtype=self.means_.dtype)
+            for start in range(0,len(datasets_flat),TILE_SIZE):
+                diff = datasets_flat[None,start:start + TILE_SIZE,:] - self.means_[:,None,:]
+                self.covars_ += np.matmul(np.swapaxes(gamma_flat[start:start + TILE_SIZE].T[:,:,None]*diff,1,2),diff)
+            self.covars_ /= Nk[:,None,None]
+        self.weights_ = np.sum(gamma_,axis=1)/self.N
             
-    def LL(self,datasets):
-        N = datasets.shape[1]
-        numsets = datasets.shape[0]
-        temp = np.zeros((numsets,N))
-        for k in range(self.numclasses):
-            temp += self.weights_[:,k][:,None]*stats.multivariate_normal.pdf(datasets,mean = self.means_[k],cov = self.covars_[k])
-        LL = np.mean(np.log(temp + 1e-80))
+    def LL(self,datasets,logjoint=None):
+        if logjoint is None:
+            logjoint = self._compute_logjoint(datasets)
+        LL = np.mean(logsumexp(logjoint.astype(np.float64),axis=2))                # reduce in double precision
         return -LL
         
-    def solve(self,datasets):
+    def _compute_logjoint(self,datasets):
+        return np.log(self.weights_[:,None,:] + 1e-80) + self._compute_log_gaussian(datasets)
+        
+    def solve(self,datasets,init_params=None,tol=1e-4,max_iter=None,rng=None):
+        # parameters are fit in the precision of datasets, float32 datasets halve the memory traffic
+        # init_params: optional (means_,covars_,weights_) to warm start EM from instead of the random initializations
+        # EM stops when the negative log-likelihood changes by less than tol or after max_iter iterations
+        # rng: np.random.Generator for the random initializations, the global numpy random state if None
+        # the datasets share the means_ and covars_ and only have their own weights_, so they are fit jointly and
+        # cannot be split into independent per-dataset fits; the E and M steps are already vectorized over datasets
         self.numsets= len(datasets)
         self.dim = datasets.shape[2]
         self.N = datasets.shape[1]
-        self.means_ = np.zeros((self.numclasses,self.dim))
-        self.covars_ = np.zeros((self.numclasses, self.dim,self.dim))
-        self.weights_ = np.zeros((self.numsets,self.numclasses))
+        covar_shape = (self.dim,) if self.covariance_type == 'diag' else (self.dim,self.dim)
+        self.means_ = np.zeros((self.numclasses,self.dim),dtype=datasets.dtype)
+        self.covars_ = np.zeros((self.numclasses,) + covar_shape,dtype=datasets.dtype)
+        self.weights_ = np.zeros((self.numsets,self.numclasses),dtype=datasets.dtype)
         
-        datasets_flat = np.reshape(datasets,(-1,datasets.shape[2]))
-        covar = np.cov(datasets_flat, rowvar = False)
-        mean = np.mean(datasets_flat, axis = 0)
-        
-        numinits = 20
-        means_init = np.zeros((numinits,self.numclasses,self.dim))
-        covars_init = np.zeros((numinits,self.numclasses,self.dim,self.dim))
-        weights_init = np.zeros((numinits,self.numsets,self.numclasses))
-        LL_init = np.zeros(numinits)
-        for init_ in range(numinits):
-            for i in range(self.numclasses):
-                means_init[init_][i] = np.random.multivariate_normal(mean,covar)
-                covars_init[init_][i] = deepcopy(covar)
+        if rng is None:
+            rng = np.random
+        if init_params is not None:
+            self.means_ = np.array(init_params[0],dtype=datasets.dtype)
+            self.covars_ = np.array(init_params[1],dtype=datasets.dtype)
+            self.weights_ = np.array(init_params[2],dtype=datasets.dtype)
+        else:
+            datasets_flat = np.reshape(datasets,(-1,datasets.shape[2]))
+            covar = np.cov(datasets_flat, rowvar = False)
+            mean = np.mean(datasets_flat, axis = 0)
+            covar_init = np.diag(covar) if self.covariance_type == 'diag' else covar
+            
+            numinits = 20
+            means_init = np.zeros((numinits,self.numclasses,self.dim),dtype=datasets.dtype)
+            covars_init = np.zeros((numinits,self.numclasses) + covar_shape,dtype=datasets.dtype)
+            weights_init = np.zeros((numinits,self.numsets,self.numclasses),dtype=datasets.dtype)
+            LL_init = np.zeros(numinits)
+            for init_ in range(numinits):
+                for i in range(self.numclasses):
+                    means_init[init_][i] = rng.multivariate_normal(mean,covar)
+                    covars_init[init_][i] = deepcopy(covar_init)
 
-            for j in range(self.numsets):
-                weights_init[init_][j] = np.random.dirichlet(5*np.ones(self.numclasses))
-            self.means_ = means_init[init_]
-            self.covars_ = covars_init[init_]
-            self.weights_ = weights_init[init_]
-            LL_init[init_] = self.LL(datasets)
-        best = np.argmin(LL_init)
-        self.means_ = means_init[best]
-        self.covars_ = covars_init[best]
-        self.weights_ = weights_init[best]
+                for j in range(self.numsets):
+                    weights_init[init_][j] = rng.dirichlet(5*np.ones(self.numclasses))
+                self.means_ = means_init[init_]
+                self.covars_ = covars_init[init_]
+                self.weights_ = weights_init[init_]
+                LL_init[init_] = self.LL(datasets)
+            best = np.argmin(LL_init)
+            self.means_ = means_init[best]
+            self.covars_ = covars_init[best]
+            self.weights_ = weights_init[best]
             
-        LL_curr = self.LL(datasets)
+        logjoint = self._compute_logjoint(datasets)
+        LL_curr = self.LL(datasets,logjoint)
         LL_prev = 0
         print("Initial negative log-likelihood per sample = %.4f" %LL_curr)
+        if not np.isfinite(LL_curr):
+            raise FloatingPointError("Negative log-likelihood is not finite at initialization, "
+                                     "fit datasets of dtype {} in float64".format(datasets.dtype))
         num = 0
-        while np.abs(LL_curr - LL_prev) > 1e-4:
-            gamma_= self.E_step(datasets)
+        # EM with Anderson acceleration: extrapolate from the last numhist EM updates and keep the
+        # extrapolated parameters only if they beat the plain EM update (monotone in the likelihood)
+        numhist = 5
+        params_em = []
+        residuals = []
+        params_curr = self._get_params()
+        while np.abs(LL_curr - LL_prev) > tol and (max_iter is None or num < max_iter):
+            gamma_= self.E_step(datasets,logjoint)
             self.M_step(datasets,gamma_)
             LL_prev = LL_curr
-            LL_curr = self.LL(datasets)
+            logjoint = self._compute_logjoint(datasets)                               # reused by the next E step
+            LL_curr = self.LL(datasets,logjoint)
+            if not np.isfinite(LL_curr):
+                raise FloatingPointError("Negative log-likelihood is not finite after {} iterations, "
+                                         "fit datasets of dtype {} in float64".format(num + 1, datasets.dtype))
+            params_em = (params_em + [self._get_params()])[-numhist-1:]
+            residuals = (residuals + [params_em[-1] - params_curr])[-numhist-1:]
+            if len(residuals) > 1:
+                dresiduals = np.diff(residuals,axis=0).T
+                dparams_em = np.diff(params_em,axis=0).T
+                alpha = np.linalg.lstsq(dresiduals,residuals[-1],rcond=None)[0]
+                weights_em,means_em,covars_em = self.weights_,self.means_,self.covars_
+                self._set_params(params_em[-1] - dparams_em @ alpha)
+                try:
+                    logjoint_acc = self._compute_logjoint(datasets)
+                    LL_acc = self.LL(datasets,logjoint_acc)
+                except np.linalg.LinAlgError:
+                    LL_acc = np.inf
+                if LL_acc < LL_curr:
+                    LL_curr = LL_acc
+                    logjoint = logjoint_acc
+                else:
+                    # keep the plain EM update exactly, without going through the projection
+                    self.weights_,self.means_,self.covars_ = weights_em,means_em,covars_em
+            params_curr = self._get_params()
             num += 1
             #print(LL_curr)
         print("Final negative log-likelihood per sample = %.4f" %LL_curr)
         print("Number of iterations = %d" %num)
         
+    def _get_params(self):
+        return np.concatenate([self.weights_.ravel(),self.means_.ravel(),self.covars_.ravel()])
+        
+    def _set_params(self,params):
+        # unpack a parameter vector from _get_params, projecting the weights back onto the simplex
+        # and the covariances onto symmetric matrices with eigenvalues >= 1e-6
+        nw = self.weights_.size
+        nm = self.means_.size
+        weights_ = np.clip(params[:nw].reshape(self.weights_.shape),1e-10,None)
+        self.weights_ = weights_/np.sum(weights_,axis=1)[:,None]
+        self.means_ = params[nw:nw+nm].reshape(self.means_.shape).copy()
+        covars_ = params[nw+nm:].reshape(self.covars_.shape)
+        if self.covariance_type == 'diag':
+            self.covars_ = np.clip(covars_,1e-6,None)
+        else:
+            covars_ = 0.5*(covars_ + np.swapaxes(covars_,1,2))
+            eigvals,eigvecs = np.linalg.eigh(covars_)
+            self.covars_ = (eigvecs*np.clip(eigvals,1e-6,None)[:,None,:]) @ np.swapaxes(eigvecs,1,2)
+        
+    def _compute_log_gaussian(self,y):
+        # log N(y|means_[k],covars_[k]) for all components at once, shape y.shape[:-1] + (numclasses,)
+        # Mahalanobis distances from the differences y - mu_k, which keeps them accurate in float32 when the data is far from the origin,
+        # blocks of TILE_SIZE samples at a time so the differences of all components stay small
+        dim = self.means_.shape[1]
+        y_flat = np.reshape(y,(-1,dim))
+        if self.covariance_type == 'diag':
+            # diagonal covariances: sum_d ((y_d - mu_kd)/std_kd)^2, O(dim) per component
+            prec_std = 1/np.sqrt(self.covars_)
+            logdet = np.sum(np.log(self.covars_),axis=1)
+        else:
+            # full covariances: z_k = prec_chol_k (y - mu_k) with one batched product over the components
+            chol = np.linalg.cholesky(self.covars_)
+            prec_chol_T = np.linalg.inv(chol).transpose(0,2,1)
+            logdet = 2*np.sum(np.log(np.diagonal(chol,axis1=1,axis2=2)),axis=1)
+        maha = np.zeros((len(y_flat),self.numclasses),dtype=np.result_type(y_flat,self.covars_))
+        for start in range(0,len(y_flat),TILE_SIZE):
+            if self.covariance_type == 'diag':
+                z = y_flat[start:start + TILE_SIZE,None] - self.means_
+                z *= prec_std
+                maha[start:start + TILE_SIZE] = np.einsum('tkd,tkd->tk',z,z)
+            else:
+                z = np.matmul(y_flat[None,start:start + TILE_SIZE] - self.means_[:,None],prec_chol_T)
+                maha[start:start + TILE_SIZE] = np.sum(z**2,axis=-1).T
+        maha = np.reshape(maha,y.shape[:-1] + (self.numclasses,))
+        return -0.5*(float(dim*np.log(2*np.pi)) + logdet + maha)
+        
     def _compute_posterior(self,y,set_index):
-        post = np.zeros((self.numclasses,y.shape[0]))
-        for k in range(self.numclasses):
-            post[k] = self.weights_[set_index][k]*self._compute_likelihood(y,k)
+        post = self.weights_[set_index][:,None]*np.exp(self._compute_log_gaussian(y).T)
         return post/np.sum(post,axis=0)
         
+    def _compute_states(self,y,set_index):
+        # argmax of the posterior, computed from the log joint without normalizing
+        # blocks of TILE_SIZE samples at a time, only the states are kept so memory stays O(N)
+        states = np.zeros(y.shape[0],dtype=int)
+        logweights = np.log(self.weights_[set_index] + 1e-80)
+        for start in range(0,y.shape[0],TILE_SIZE):
+            logjoint = logweights + self._compute_log_gaussian(y[start:start + TILE_SIZE])
+            states[start:start + TILE_SIZE] = np.argmax(logjoint,axis=1)
+        return states
+        
     def _compute_likelihood(self,y,s):
-        return stats.multivariate_normal.pdf(y,mean = self.means_[s],cov = self.covars_[s])
+        return stats.multivariate_normal.pdf(y,mean = self.means_[s],cov = self._full_covar(s))
+    
+    def _full_covar(self,s):
+        if self.covariance_type == 'diag':
+            return np.diag(self.covars_[s])
+        return self.covars_[s]
     
     def _compute_log_likelihood(self,data):
-        Y = np.zeros((len(data),self.numclasses))
-        for k in range(self.numclasses):
-            Y[:,k] = np.log(stats.multivariate_normal.pdf(data,mean = self.means_[k],cov = self.covars_[k]) + 1e-80)
+        Y = np.logaddexp(self._compute_log_gaussian(data),np.log(1e-80))
         return Y
     def score(self,dataset,set_index):
-        temp = np.zeros(len(dataset))
-        for k in range(self.numclasses):
-            temp += self.weights_[set_index,k]*stats.multivariate_normal.pdf(dataset,mean = self.means_[k],cov = self.covars_[k])
-        LL = np.sum(np.log(temp + 1e-80))
+        logjoint = np.log(self.weights_[set_index] + 1e-80) + self._compute_log_gaussian(dataset)
+        LL = np.sum(logsumexp(logjoint.astype(np.float64),axis=1))
         return LL
         
     def _generate_sample_from_state(self,s):
-        return np.random.multivariate_normal(self.means_[s],self.covars_[s])
+        return np.random.multivariate_normal(self.means_[s],self._full_covar(s))
     
     def _read_params(self,means_,covars_,weights_):
         self.numclasses = means_.shape[0]
         self.means_ = means_
         self.covars_ = covars_
         self.weights_ = weights_
+        self.covariance_type = 'diag' if covars_.ndim == 2 else 'full'
         
     def _save_params(self,filename):
-        np.save(filename + "_means",self.means_)
-        np.save(filename + "_covars",self.covars_)
-        np.save(filename + "_weights",self.weights_)
+        # saved in float64 whatever the precision of the fit, as expected by the scripts loading them
+        np.save(filename + "_means",self.means_.astype(np.float64))
+        np.save(filename + "_covars",self.covars_.astype(np.float64))
+        np.save(filename + "_weights",self.weights_.astype(np.float64))
 
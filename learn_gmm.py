@@ -22,10 +22,25 @@ import time
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from joblib import Parallel, delayed
 #data processing functions
 from GMM import GMM_model
 
 
+def fit_dtype(datasets):
+    """
+    Precision in which to fit the GMM. float32 halves the memory and time of EM, but when a feature is offset from zero
+    by much more than its spread the within-cluster variations fall below float32 resolution, fall back to float64 then
+
+    Parameters:
+    datasets: A list of datasets, each of size num_bouts x n_features. Only a strided subsample of every dataset is read
+    """
+
+    sample = np.concatenate([data[::max(1,len(data)//10000)] for data in datasets]).astype(np.float64)
+    offset = np.abs(np.mean(sample,axis=0))/(np.std(sample,axis=0) + 1e-300)
+    return np.float32 if np.max(offset) < 100 else np.float64
+
+
 def train(args, datasets, n_cluster):
     """
     Learn a GMM on datasets with a set number of clusters and save the parameters:
@@ -37,18 +52,20 @@ def train(args, datasets, n_cluster):
     n_cluster: Chosen number of clusters. default type - int
     """
 
-    model_fit = GMM_model(n_cluster) 
+    model_fit = GMM_model(n_cluster, args.CovarianceType)
     if args.Load == False:
         length_min = np.min([len(data) for data in datasets])
         split_size = int((2/3)*length_min)                                         # 60% train/val split
-        datasets_train = np.zeros((len(datasets),split_size,datasets[0].shape[1])) # 3d array for subsampled dataset
+        datasets_train = np.zeros((len(datasets),split_size,datasets[0].shape[1]),dtype=fit_dtype(datasets)) # 3d array for subsampled dataset
 
+        rng = np.random.default_rng(args.Seed)
         for s in range(len(datasets)):
-            subsample = np.random.choice(len(datasets[s]),split_size)
-            datasets_train[s] = datasets[s][subsample]
+            perm = rng.permutation(len(datasets[s]))                               # subsample without replacement
+            datasets_train[s] = datasets[s][np.sort(perm[:split_size])]
 
-        model_fit.solve(datasets_train)
+        model_fit.solve(datasets_train, rng=rng)
         model_fit._save_params(args.PathGMM + args.GMMName)
+        save_states(args, model_fit, datasets)
 
         return model_fit
 
@@ -66,9 +83,74 @@ def train(args, datasets, n_cluster):
         return model_fit
 
 
+def save_states(args, model_fit, datasets):
+    """
+    Save the bout types (most likely GMM state of each bout) of every dataset next to the GMM parameters,
+    as GMMName_DataName_states_condition(x).npy, so that the bout types can be analyzed without recomputing the posteriors.
+    Only called right after learning the GMM, when the weights of condition args.Condition[s] are known to be weights_[s]
+
+    Parameters:
+    args: Argparse object containing general arguments
+    model_fit: GMM_model learnt on datasets
+    datasets: A list of datasets in the order of args.Condition. Each dataset in the list should be num_bouts x n_features.
+    """
+
+    for s,n in enumerate(args.Condition):
+        statespath = args.PathGMM + args.GMMName + "_" + args.DataName + "_states_condition{}.npy".format(n)
+        np.save(statespath, model_fit._compute_states(datasets[s],s))
+
+
+def val_fit(datasets, n_cluster, n_reps, seed, split_size, test_size, covariance_type='full', dtype=np.float32):
+    """
+    Train n_reps Gaussian Mixture models with a fixed number of clusters on random train/test splits and return the held-out log likelihoods.
+    Run as a separate job for every number of clusters tested in val(). Every repetition after the first is initialized from the
+    (jittered) fit of the previous one, so the repetitions share their initialization and are not fully independent
+
+    Parameters:
+    datasets: A list of datasets over which to learn GMM. Size of list should be number of conditions/experiments
+              Each dataset in the list should be num_bouts x n_features.
+    n_cluster: Number of clusters of the GMM. default type - int
+    n_reps: Number of repititions to perform for error bars
+    seed: Seed (int or np.random.SeedSequence) for the train/test splits and the GMM initializations of this job
+    split_size: Number of bouts per dataset to train on
+    test_size: Number of held-out bouts per dataset to compute the log likelihood on
+    covariance_type: 'full' or 'diag' covariances of the GMM components
+    dtype: Precision in which the GMMs are fit, see fit_dtype()
+    """
+
+    rng = np.random.default_rng(seed)
+    LLs = []
+    params = None
+    n_features = datasets[0].shape[1]
+    datasets_train = np.empty((len(datasets),split_size,n_features),dtype=dtype)   # 3d array for subsampled dataset, reused across reps
+    datasets_test = np.empty((len(datasets),test_size,n_features),dtype=dtype)
+
+    for j in range(n_reps):
+        print('clusters = ', n_cluster, ', iter = ', j)
+        model_fit = GMM_model(n_cluster, covariance_type)
+
+        for s in range(len(datasets)):
+            perm = rng.permutation(len(datasets[s]))                                   # disjoint train/test split
+            # fill the buffers (casting to their dtype), sorted indices read the (memory-mapped) dataset sequentially
+            datasets_train[s] = datasets[s][np.sort(perm[:split_size])]
+            datasets_test[s] = datasets[s][np.sort(perm[split_size:split_size + test_size])]
+
+        # Warm start from the previous repetition, which converges in a few iterations on the new split
+        model_fit.solve(datasets_train, init_params=params, rng=rng)
+        # jitter the means by a tenth of each component's spread so that the next repetition can leave this optimum
+        variances = model_fit.covars_ if covariance_type == 'diag' else np.diagonal(model_fit.covars_,axis1=1,axis2=2)
+        means_ = model_fit.means_ + 0.1*np.sqrt(variances)*rng.standard_normal(model_fit.means_.shape)
+        params = (means_, model_fit.covars_, model_fit.weights_)
+        LLs += [model_fit.LL(datasets_test)]
+
+    return LLs
+
+
 def val(args, datasets,clusters,n_reps):
     """
     Train a Gaussian Mixture models and plot the log likelihood for selected range of clusters in order to select the number of clusters
+    The numbers of clusters are fit in parallel over args.NJobs processes. The n_reps repetitions differ in their train/test split,
+    but are warm-started from one another (see val_fit()), so the error bars reflect split rather than initialization variability
 
     Parameters:
     args: Argparse object containing general arguments
@@ -78,26 +160,15 @@ def val(args, datasets,clusters,n_reps):
     n_reps: Number of repititions to perform for error bars
     """
 
-    np.random.seed(args.Seed)
-    LLs = []
-    for i in clusters:
-        print('clusters = ',i)
-        LLs += [[]]
-        for j in range(n_reps):
-            print('iter = ', j)
-            model_fit = GMM_model(i)
-            length_min = np.min([len(data) for data in datasets])
-            split_size = int((2/3)*length_min)                                         # 60% train/val split
-            datasets_train = np.zeros((len(datasets),split_size,datasets[0].shape[1])) # 3d array for subsampled dataset
-            datasets_test = np.zeros((len(datasets),length_min - split_size,datasets[0].shape[1]))
-            
-            for s in range(len(datasets)):
-                subsample = np.random.choice(len(datasets[s]),split_size)
-                datasets_train[s] = datasets[s][subsample]
-                datasets_test[s] = np.delete(datasets[s],subsample,axis=0)[:length_min - split_size]
-
-            model_fit.solve(datasets_train)
-            LLs[-1] += [model_fit.LL(datasets_test)]
+    length_min = min(len(data) for data in datasets)
+    split_size = int((2/3)*length_min)                                                 # 60% train/val split
+    test_size = length_min - split_size
+    seeds = np.random.SeedSequence(args.Seed).spawn(len(clusters))                    # independent streams, one per job
+    dtype = fit_dtype(datasets)
+
+    LLs = Parallel(n_jobs=args.NJobs, backend='loky')(delayed(val_fit)(datasets, i, n_reps, seeds[idx], split_size, test_size,
+                                                                       args.CovarianceType, dtype)
+                                                       for idx,i in enumerate(clusters))
 
     #Held-out log likelihood
     plt.close("all")
@@ -129,7 +200,7 @@ def main(args):
         exit()
 
     for n in args.Condition:
-        datasets.append(np.load(datapath + "condition{}.npy".format(n)))
+        datasets.append(np.load(datapath + "condition{}.npy".format(n), mmap_mode='r'))       # rows are only paged in when subsampled
 
     if args.Type == 'train' :
         model_fit = train(args, datasets, args.N_cluster)
@@ -145,6 +216,8 @@ if __name__ == "__main__":
     parser.add_argument('-t','--Type',help="whether to train or val", default='train', type=str)
     parser.add_argument('-c','--Condition',nargs='+',help= "types of experiment to run/analyze", type=int)
     parser.add_argument('-n','--N_cluster',help="If train, set the number of clusters", default=7, type=int)
+    parser.add_argument('-j','--NJobs',help="If val, number of parallel jobs to fit the range of clusters with (-1 uses all cores)", default=-1, type=int)
+    parser.add_argument('-cv','--CovarianceType',help="covariance type of the GMM components, full or diag", default='full', type=str, choices=['full','diag'])
     parser.add_argument('-l','--Load',help="During training, whether to load a previously saved GMM or learn it",action='store_true')
     parser.add_argument('-pD','--PathData',help="path to data",default='./Data/',type=str)
     parser.add_argument('-dN','--DataName',help="name of the dataset", default='toy', type=str)